@@ -1,16 +1,17 @@
+import aiofiles
 import argparse
 import asyncio
 import httpx
+import json
 import logging
 import os
-import requests
 import shutil
 import sys
 import time
-from bs4 import BeautifulSoup
-from pathlib import Path
+from lxml import etree
+from pathlib import Path, PurePosixPath
 from typing import List, Union
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
 from pdf_merger import MangaPDFMerger
 
 
@@ -41,6 +42,12 @@ class MangaInUaParser:
                     429: 5,
                     }
 
+    CLIENT_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+    CLIENT_TIMEOUT = 30.0
+    MAX_PARALLEL_DOWNLOADS = 32
+    STREAM_CHUNK_SIZE = 65536
+    CACHE_FILE_NAME = '.cache.json'
+
     def __init__(self, manga_url: str, base_url: str = None,
                  data_folder: Union[str, Path, None] = None,
                  logger: logging.Logger = None):
@@ -63,123 +70,229 @@ class MangaInUaParser:
             self.data_folder.mkdir()
 
         self.errors = []
-
-    def get_chapters_links(self) -> List[str]:
-        soup = BeautifulSoup(requests.get(self.manga_url).content, features='html.parser')
-        links = [el[self.CHAPTER_URL_ATTR] for el in soup.find_all(class_=self.CHAPTER_LINKS_CLASS)]
+        self._client: Union[httpx.AsyncClient, None] = None
+        self._loop: Union[asyncio.AbstractEventLoop, None] = None
+        self._sem = asyncio.Semaphore(self.MAX_PARALLEL_DOWNLOADS)
+        self._chapters_links: Union[List[str], None] = None
+        self._images_urls: dict = {}
+        self._url_cache: dict = self.load_url_cache()
+
+    def get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(limits=self.CLIENT_LIMITS,
+                                             http2=True,
+                                             timeout=self.CLIENT_TIMEOUT)
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+        return self._loop
+
+    def close(self) -> None:
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.run_until_complete(self.aclose())
+            self._loop.close()
+
+    @property
+    def url_cache_path(self) -> Path:
+        # Kept next to the data folder, not inside it, so the data folder
+        # holds chapter folders only and the merge step never sees the file.
+        return self.data_folder.parent / f'{self.data_folder.name}{self.CACHE_FILE_NAME}'
+
+    def load_url_cache(self) -> dict:
+        if self.url_cache_path.exists():
+            try:
+                return json.loads(self.url_cache_path.read_text())
+            except (ValueError, OSError) as e:
+                self.logger.warning(f'Unable to read url cache {self.url_cache_path}: {e}')
+
+        return {}
+
+    def save_url_cache(self) -> None:
+        if self._url_cache:
+            self.url_cache_path.write_text(json.dumps(self._url_cache))
+
+    async def collect_attrs_from_page(self, url: str, attr: str, classes: str = '') -> tuple:
+        """Streams the page and pulls attr values out of the parser as chunks arrive,
+        so parsing overlaps with the network receive. Returns (status_code, values)."""
+        required_classes = set(classes.split())
+        values = []
+
+        def read_values():
+            for _, element in pull_parser.read_events():
+                value = element.get(attr)
+                if value and required_classes.issubset(element.get('class', '').split()):
+                    values.append(value)
+
+        async with self.get_client().stream('GET', url) as resp:
+            pull_parser = etree.HTMLPullParser(events=('start',))
+            async for chunk in resp.aiter_bytes(self.STREAM_CHUNK_SIZE):
+                pull_parser.feed(chunk)
+                read_values()
+
+            try:
+                pull_parser.close()
+            except etree.XMLSyntaxError:
+                pass
+            read_values()
+
+        return resp.status_code, values
+
+    async def get_chapters_links(self) -> List[str]:
+        if self._chapters_links is not None:
+            return self._chapters_links
+
+        _, links = await self.collect_attrs_from_page(self.manga_url,
+                                                      attr=self.CHAPTER_URL_ATTR,
+                                                      classes=self.CHAPTER_LINKS_CLASS)
         self.logger.debug(f'Found links: {", ".join(links)}')
+        self._chapters_links = links
         return links
 
-    def get_images_urls(self, chapter_url: str) -> List[str]:
+    async def get_images_urls(self, chapter_url: str) -> List[str]:
+        if chapter_url in self._images_urls:
+            return self._images_urls[chapter_url]
+
         images_urls = []
         for attempt in range(0, self.DOWNLOAD_ATTEMPTS + 1):
-            resp = requests.get(chapter_url)
-            soup = BeautifulSoup(resp.content, features='html.parser')
-            images_urls = [el[self.IMAGE_URL_ATTR] for el in soup.find_all(attrs={self.IMAGE_URL_ATTR: True})]
+            status_code, images_urls = await self.collect_attrs_from_page(chapter_url, attr=self.IMAGE_URL_ATTR)
             if not images_urls:
-                self.logger.warning(f'{resp.status_code} - {chapter_url} {attempt}/{self.DOWNLOAD_ATTEMPTS}')
-                if resp.status_code == 429 and attempt != self.DOWNLOAD_ATTEMPTS:
+                self.logger.warning(f'{status_code} - {chapter_url} {attempt}/{self.DOWNLOAD_ATTEMPTS}')
+                if status_code == 429 and attempt != self.DOWNLOAD_ATTEMPTS:
                     self.logger.warning(f' Too many requests {chapter_url}. Making pause.')
-                    time.sleep(self.ERRORS_PAUSE[resp.status_code])
+                    await asyncio.sleep(self.ERRORS_PAUSE[status_code])
                     continue
 
-                raise Exception(
-                    f'No images found. ({resp.status_code}){soup.find_all(attrs={self.IMAGE_URL_ATTR: True})}')
+                raise Exception(f'No images found. ({status_code}){images_urls}')
             else:
                 break
 
+        self._images_urls[chapter_url] = images_urls
         return images_urls
 
-    def ping_site(self) -> int:
+    async def ping_site(self) -> int:
         self.logger.info(f'Pinging {self.base_url}')
-        return requests.get(self.base_url).status_code
+        return (await self.get_client().get(self.base_url)).status_code
 
-    @staticmethod
-    def save_img(path: Path, data: bytes) -> None:
-        with open(path, 'wb') as f:
-            f.write(data)
+    async def save_img(self, path: Path, response: httpx.Response) -> None:
+        async with aiofiles.open(path, 'wb') as f:
+            async for chunk in response.aiter_bytes(self.STREAM_CHUNK_SIZE):
+                await f.write(chunk)
+
+            if hasattr(os, 'posix_fadvise'):
+                # The image is not read again until the PDF step, so hint the
+                # kernel to drop its pages instead of evicting useful cache.
+                await f.flush()
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
 
     async def async_download_image(self, img_url: str, img_path: Path, downloaded_string: str = '') -> None:
         start = time.time()
-        async with httpx.AsyncClient() as client:
+        client = self.get_client()
+
+        headers = {}
+        cached = self._url_cache.get(img_url)
+        if cached and cached.get('etag') and img_path.exists():
+            headers['If-None-Match'] = cached['etag']
+
+        async with self._sem:
             for attempt in range(0, self.DOWNLOAD_ATTEMPTS + 1):
                 try:
-                    response = await client.get(img_url)
+                    async with client.stream('GET', img_url, headers=headers) as response:
+                        attempt_str = f'{attempt}/{self.DOWNLOAD_ATTEMPTS} attempt'
+                        if response.status_code == 304:
+                            self.logger.debug(f'Not modified {downloaded_string}, reusing {img_path}')
+                            break
+                        if response.status_code != 200:
+                            self.logger.info(f'Download code: {response.status_code}')
+                        if response.status_code == 404:
+                            self.logger.error(f'Unable to download {img_url}(reason {response.status_code})')
+                            self.errors.append(f'{img_url} unable to download({response.status_code})')
+                            break
+                        elif response.status_code == 503:
+                            self.logger.error(f'Error during download {img_url}(reason {response.status_code})'
+                                              f' {attempt_str}. Making pause.')
+                            await asyncio.sleep(self.ERRORS_PAUSE[response.status_code])
+                            if attempt == self.DOWNLOAD_ATTEMPTS:
+                                self.errors.append(f'{img_url} unable to download({response.status_code})')
+
+                                break
+                            else:
+                                self.logger.info(f'Trying to download {img_url}')
+                                continue
+
+                        await self.save_img(img_path, response)
+                        etag = response.headers.get('etag')
+                        if etag:
+                            self._url_cache[img_url] = {'etag': etag,
+                                                        'content_length': response.headers.get('content-length')}
+                        self.logger.debug(f'Downloaded {downloaded_string}({round(time.time() - start, 2)} sec)')
+                        break
                 except Exception as e:
                     self.logger.warning(f'Error during chapter {downloaded_string}({img_url}) image download.{e}')
                     if attempt == self.DOWNLOAD_ATTEMPTS:
                         self.logger.error(f'Failed to download: {img_url}')
-                else:
-                    attempt_str = f'{attempt}/{self.DOWNLOAD_ATTEMPTS} attempt'
-                    if response.status_code != 200:
-                        self.logger.info(f'Download code: {response.status_code}')
-                    if response.status_code == 404:
-                        self.logger.error(f'Unable to download {img_url}(reason {response.status_code})')
-                        self.errors.append(f'{img_url} unable to download({response.status_code})')
-                        break
-                    elif response.status_code == 503:
-                        self.logger.error(f'Error during download {img_url}(reason {response.status_code})'
-                                          f' {attempt_str}. Making pause.')
-                        time.sleep(self.ERRORS_PAUSE[response.status_code])
-                        if attempt == self.DOWNLOAD_ATTEMPTS:
-                            self.errors.append(f'{img_url} unable to download({response.status_code})')
 
-                            break
-                        else:
-                            self.logger.info(f'Trying to download {img_url}')
-                            continue
-
-                    self.save_img(img_path, response.content)
-                    self.logger.debug(f'Downloaded {downloaded_string}({round(time.time() - start, 2)} sec)')
-                    break
-
-    @staticmethod
-    async def __gather_coroutines(*coroutines: Union[asyncio.Task, 'Coroutine']):
-        await asyncio.gather(*coroutines)
-
-    def download_images(self, images_links: List[str], chapter_folder: Path, chapter_string: str):
+    async def download_images(self, images_links: List[str], chapter_folder: Path, chapter_string: str):
         coroutines = []
 
         for img, img_url in enumerate(images_links, start=1):
             downloaded_string = f'{chapter_string} - image {img}/{len(images_links)}'
             img_url = urljoin(self.base_url, img_url)
-            img_path = chapter_folder / f'{img}.{img_url.split(".")[-1]}'
+            img_path = chapter_folder / f'{img}{PurePosixPath(urlparse(img_url).path).suffix}'
             coroutines.append(self.async_download_image(img_url=img_url,
                                                         img_path=img_path,
                                                         downloaded_string=downloaded_string))
 
-        asyncio.run(self.__gather_coroutines(*coroutines))
+        await asyncio.gather(*coroutines)
 
-    def download_chapter(self, url: str, chapter_folder: Path, chapter_string: str = ''):
+    async def download_chapter(self, url: str, chapter_folder: Path, chapter_string: str = ''):
         start = time.time()
-        images_urls = self.get_images_urls(url)
+        images_urls = await self.get_images_urls(url)
 
-        self.download_images(images_links=images_urls,
-                             chapter_folder=chapter_folder,
-                             chapter_string=chapter_string)
+        await self.download_images(images_links=images_urls,
+                                   chapter_folder=chapter_folder,
+                                   chapter_string=chapter_string)
         self.logger.info(f'Chapter {chapter_string} downloaded, '
                          f'{len(images_urls)} images within {round(time.time() - start, 2)} sec.')
 
     def parse(self, forced: bool = False):
+        self.get_loop().run_until_complete(self._parse(forced=forced))
+
+    async def _parse(self, forced: bool = False):
         try:
             self.check_data_folder_for_content()
         except FileExistsError:
             if forced:
                 self.logger.info(f'Deleting {self.data_folder}')
                 shutil.rmtree(self.data_folder)
+                self._url_cache.clear()
+                self.url_cache_path.unlink(missing_ok=True)
+
+        try:
+            chapters_urls = await self.get_chapters_links()
 
-        chapters_urls = self.get_chapters_links()
+            self.logger.debug(f'Found chapters links: {", ".join(chapters_urls)}')
+            self.data_folder.mkdir(exist_ok=True)
+            global_start = time.time()
 
-        self.logger.debug(f'Found chapters links: {", ".join(chapters_urls)}')
-        self.data_folder.mkdir(exist_ok=True)
-        global_start = time.time()
+            coroutines = []
+            for i, url in enumerate(chapters_urls, start=1):
+                chapter_string = f'{i}/{len(chapters_urls)}'
+                chapter_folder = self.data_folder / str(i)
+                chapter_folder.mkdir(exist_ok=True)
 
-        for i, url in enumerate(chapters_urls, start=1):
-            chapter_string = f'{i}/{len(chapters_urls)}'
-            chapter_folder = self.data_folder / str(i)
-            chapter_folder.mkdir(exist_ok=True)
+                coroutines.append(self.download_chapter(url=url,
+                                                        chapter_folder=chapter_folder,
+                                                        chapter_string=chapter_string))
 
-            self.download_chapter(url=url, chapter_folder=chapter_folder, chapter_string=chapter_string)
+            await asyncio.gather(*coroutines)
+        finally:
+            self.save_url_cache()
 
         self.logger.info(f'All chapters({len(chapters_urls)}) '
                          f'downloaded within {time.strftime("%Hh %Mm %Ss", time.gmtime(time.time() - global_start))}.')
@@ -189,18 +302,24 @@ class MangaInUaParser:
             raise FileExistsError(f'Folder {self.data_folder} already exists and contain files.')
 
     def download_image_by_chapter_and_index(self, chapter: int, img: int):
-        chapter_url = self.get_chapters_links()[chapter - 1]
-        chapter_folder = self.data_folder / str(chapter)
-        if not chapter_folder.exists():
-            chapter_folder.mkdir()
+        self.get_loop().run_until_complete(self._download_image_by_chapter_and_index(chapter=chapter, img=img))
+
+    async def _download_image_by_chapter_and_index(self, chapter: int, img: int):
+        try:
+            chapter_url = (await self.get_chapters_links())[chapter - 1]
+            chapter_folder = self.data_folder / str(chapter)
+            if not chapter_folder.exists():
+                chapter_folder.mkdir()
 
-        img_url = urljoin(self.base_url, self.get_images_urls(chapter_url)[img - 1])
-        file_path = chapter_folder / str(img)
-        self.logger.info(f'Downloading image {chapter}-{img}({img_url}) to {file_path}')
+            img_url = urljoin(self.base_url, (await self.get_images_urls(chapter_url))[img - 1])
+            file_path = chapter_folder / str(img)
+            self.logger.info(f'Downloading image {chapter}-{img}({img_url}) to {file_path}')
 
-        asyncio.run(self.__gather_coroutines(self.async_download_image(img_url=img_url,
-                                                                       img_path=file_path,
-                                                                       downloaded_string=str(img))))
+            await self.async_download_image(img_url=img_url,
+                                            img_path=file_path,
+                                            downloaded_string=str(img))
+        finally:
+            self.save_url_cache()
 
 
 def parse_args() -> argparse.Namespace:
@@ -220,13 +339,14 @@ def parse_args() -> argparse.Namespace:
     args_parser.add_argument('--one_file', action='store_true', default=False,
                              help='Merge all manga in single pdf.')
 
-    args_parser.add_argument('--keep_temp', action='store_true', help='Keep temp folder.', default=False)
     args_parser.add_argument('--keep_data', action='store_true', default=False,
                              help='Keep folder with downloaded images.')
 
     args_parser.add_argument('--force', action='store_true', help='Delete folder if exists', default=False)
     args_parser.add_argument('--resolution', '-r', type=float, help='PDF resolution.', default=100.)
-    args_parser.add_argument('--cpu', type=int, help='CPUs.', default=os.cpu_count())
+    args_parser.add_argument('--max_dim', type=int, default=None,
+                             help='Downscale images so the longest side is at most N pixels.')
+    args_parser.add_argument('--cpu', type=int, help='CPUs.', default=None)
 
     args_parser.add_argument('--log_level', choices=tuple(range(0, 51, 10)),
                              help='Log level', default=logging.INFO)
@@ -246,19 +366,24 @@ def main():
                              base_url=args.base_url,
                              data_folder=args.data_folder,
                              logger=logger)
-    parser.parse(forced=args.force)
+    try:
+        parser.parse(forced=args.force)
+    finally:
+        parser.close()
 
     result_pdf = args.result_pdf if args.result_pdf else f"{args.url.split('/')[-1].split('.')[-2]}.pdf"
     result_folder = args.result_folder if args.result_folder else args.url.split('/')[-1].split('.')[-2]
-    MangaPDFMerger.CPU = args.cpu
+    if args.cpu:
+        MangaPDFMerger.CPU = args.cpu
     pdf_merge = MangaPDFMerger(result_folder=result_folder,
                                data_folder=parser.data_folder,
                                logger=logger,
                                resolution=args.resolution,
                                result_pdf=result_pdf,
+                               max_dim=args.max_dim,
                                )
 
-    pdf_merge.merge(args.force, delete_temp=not args.keep_temp, merge_to_one_pdf=args.one_file)
+    pdf_merge.merge(args.force, merge_to_one_pdf=args.one_file)
 
     if args.join_every is not None:
         logger.info(f'Joining every {args.join_every} in {result_folder}')
@@ -1,38 +1,88 @@
+import hashlib
+import io
+import mmap
 import os
 import shutil
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import repeat
 from logging import Logger
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Value, cpu_count
 from pathlib import Path
 
-import PyPDF2.errors
-from PIL import Image
-from PyPDF2 import PdfMerger
-from typing import List
+import img2pdf
+import pikepdf
+from PIL import Image, UnidentifiedImageError
+from typing import List, Union
 
 
-def convert_image_to_pdf(img_path: Path, pdf_path: Path, resolution: float = 100.):
+def convert_image_to_pdf(img_path: Path, resolution: float = 100., max_dim: int = None) -> bytes:
+    buffer = io.BytesIO()
     try:
-        with open(pdf_path, 'wb') as f:
-            Image.open(Path(img_path)).convert('RGB').save(f, "PDF", resolution=resolution)
-    except PyPDF2.errors.EmptyFileError:
+        # Memory-map the file so the image bytes come straight from the page
+        # cache instead of going through buffered read syscalls.
+        with open(img_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            image = Image.open(io.BytesIO(mapped))
+            # Lets libjpeg decode straight to RGB, avoiding a second
+            # colorspace pass for CMYK/YCbCr jpegs; with a max_dim target it
+            # also decodes at a reduced scale natively. No-op for other formats.
+            image.draft('RGB', (max_dim, max_dim) if max_dim else image.size)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+
+            if max_dim:
+                image.thumbnail((max_dim, max_dim), Image.Resampling.BOX)
+
+            image.save(buffer, "PDF", resolution=resolution)
+    except (UnidentifiedImageError, ValueError):
         raise Exception(f'Unable to convert an empty file: {img_path}')
 
+    return buffer.getvalue()
 
-def sort_function(file_path: Path) -> int:
-    return int(file_path.parent.name) * 1000 + int(file_path.name.replace(file_path.suffix, ''))
+
+def physical_core_ids() -> List[int]:
+    """One cpu id per physical core (the lowest sibling), read from sysfs
+    topology. Hyperthread siblings share decode units, so counting or pinning
+    them separately only oversubscribes the cores. Empty where sysfs is absent."""
+    cores = set()
+    try:
+        for siblings in Path('/sys/devices/system/cpu').glob('cpu[0-9]*/topology/thread_siblings_list'):
+            cores.add(int(siblings.read_text().replace('-', ',').split(',')[0]))
+    except (OSError, ValueError):
+        return []
+
+    return sorted(cores)
+
+
+def _init_chapter_worker(worker_counter: 'Value', cores: List[int]):
+    """Pins every pool worker to its own core and lowers its priority, so the
+    decode loops stop migrating between cores and the machine stays usable."""
+    if hasattr(os, 'sched_setaffinity') and cores:
+        with worker_counter.get_lock():
+            worker_index = worker_counter.value
+            worker_counter.value += 1
+
+        os.sched_setaffinity(0, {cores[worker_index % len(cores)]})
+
+    if hasattr(os, 'nice'):
+        os.nice(5)
 
 
 class MangaPDFMerger:
-    CPU: int = cpu_count()
-    TEMPORARY_FOLDER_NAME: str = 'temp'
+    CPU: int = len(physical_core_ids()) or cpu_count()
+    CACHE_FOLDER_NAME: str = 'pdf_cache'
+    # Formats img2pdf can not embed directly, converted via PIL before packing.
+    IMG2PDF_UNSUPPORTED_FORMATS: tuple = ('.webp',)
+    # How many source PDFs to append before flushing the merge result to disk.
+    MERGE_SPILL_EVERY: int = 100
 
     def __init__(self, result_folder: Path,
                  data_folder: Path,
                  logger: Logger,
                  result_pdf: Path = None,
                  img_formats: tuple = ('.jpg', '.png', '.webp'),
-                 resolution: float = 100.0):
+                 resolution: float = 100.0,
+                 max_dim: int = None):
 
         self.result_folder: Path = Path(result_folder)
         if result_pdf:
@@ -45,96 +95,206 @@ class MangaPDFMerger:
 
         self.logger: Logger = logger
         self.base_folder: Path = Path(data_folder)
+        self.cache_folder: Path = self.base_folder.parent / self.CACHE_FOLDER_NAME
         self.img_formats = img_formats
         self.resolution: float = resolution
+        self.max_dim: int = max_dim
 
     def collect_images_in_folder(self, folder: Path) -> List[Path]:
-        images: List[Path] = []
-        for file in os.listdir(folder):
-            file = folder / str(file)
-            if file.suffix in self.img_formats:
-                images.append(file)
+        with os.scandir(folder) as entries:
+            images: List[Path] = [folder / entry.name for entry in entries
+                                  if entry.is_file() and entry.name.endswith(self.img_formats)]
 
-        images.sort(key=sort_function)
-        return images
+        # Precomputed keys: chapter folders and image files are both numbered.
+        keyed = [(int(path.parent.name) * 1000 + int(path.stem), path) for path in images]
+        keyed.sort()
+        return [path for _, path in keyed]
 
-    def convert_images_in_folder_to_pdf(self, folder: Path, result_pdf: Path = None):
+    @staticmethod
+    def link_or_copy(source: Path, target: Path) -> None:
+        if target.exists():
+            os.remove(target)
+
+        try:
+            # A hardlink consumes no extra disk and no bandwidth; copyfile
+            # (itself zero-copy where the OS supports it) covers filesystems
+            # without hardlinks and cross-device setups.
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+    def images_cache_key(self, images: List[Path]) -> str:
+        state = f'{self.resolution}:{self.max_dim}'.encode()
+        state += b''.join(f'{p.name}:{p.stat().st_size}:{int(p.stat().st_mtime)}'.encode() for p in images)
+        return hashlib.blake2b(state).hexdigest()
+
+    def convert_images_in_folder_to_pdf(self, folder: Path, result_pdf: Path = None,
+                                        force: bool = False) -> Union[str, None]:
+        """Returns the cache key of the produced pdf, so merge() can tell
+        which cache entries this run actually used."""
         folder = Path(folder)
         start = time.time()
         images: List[Path] = self.collect_images_in_folder(folder)
 
         if not images:
             self.logger.warning(f'No images in {folder}')
-            return
+            return None
 
         result_pdf = Path(result_pdf) if result_pdf else self.result_folder
         result_pdf.parent.mkdir(parents=True, exist_ok=True)
 
-        temp_folder = self.base_folder.parent / self.TEMPORARY_FOLDER_NAME / folder.name
-        temp_folder.mkdir(exist_ok=True, parents=True)
-
-        pdfs = []
-        pool = Pool(processes=self.CPU)
-        for i, image_path in enumerate(images, start=1):
-            pdf_path = temp_folder / f'{image_path.parent.name}_{image_path.name}.pdf'
-            pdfs.append(pdf_path)
-            pool.apply_async(convert_image_to_pdf,
-                             kwds=dict(img_path=image_path, pdf_path=pdf_path, resolution=self.resolution))
-
-        pool.close()
-        pool.join()
-        self.merge_pdfs(*pdfs, result_pdf=result_pdf)
+        cache_key = self.images_cache_key(images)
+        cached_pdf = self.cache_folder / f'{cache_key}.pdf'
+        if not force and cached_pdf.exists():
+            self.link_or_copy(cached_pdf, result_pdf)
+            self.logger.info(f'Reused cached pdf for {folder} -> {result_pdf}')
+            return cache_key
+
+        if self.max_dim:
+            # Downscaling requires a re-encode, so img2pdf's raw embedding
+            # can not be used here.
+            self.convert_images_with_pil(images=images, result_pdf=result_pdf)
+        else:
+            try:
+                self.pack_images_to_single_pdf(images=images, result_pdf=result_pdf)
+            except Exception as e:
+                self.logger.warning(f'img2pdf failed for {folder}({e}). Falling back to PIL conversion.')
+                self.convert_images_with_pil(images=images, result_pdf=result_pdf)
+
+        self.cache_folder.mkdir(exist_ok=True, parents=True)
+        self.link_or_copy(result_pdf, cached_pdf)
         self.logger.info(f'Created pdf {result_pdf} from {folder}({len(images)} imgs)'
                          f' in {round(time.time() - start, 2)} sec.')
+        return cache_key
 
-    @staticmethod
-    def merge_pdfs(*pdfs: Path, result_pdf: Path):
-        pdf_merger = PdfMerger()
-        try:
-            for pdf_path in pdfs:
-                pdf_merger.append(pdf_path)
+    def prune_pdf_cache(self, used_keys: set):
+        """Drops cache entries a run did not touch. Keys include image mtimes,
+        so re-downloaded images never hit the old entries again and keeping
+        them would grow the cache folder without bound."""
+        if not self.cache_folder.exists():
+            return
 
-            with open(result_pdf, 'wb') as f:
-                pdf_merger.write(f)
+        with os.scandir(self.cache_folder) as entries:
+            for entry in entries:
+                if entry.name.endswith('.pdf') and Path(entry.name).stem not in used_keys:
+                    os.remove(entry.path)
+
+    def pack_images_to_single_pdf(self, images: List[Path], result_pdf: Path):
+        inputs = []
+        for image_path in images:
+            if image_path.suffix in self.IMG2PDF_UNSUPPORTED_FORMATS:
+                buffer = io.BytesIO()
+                Image.open(image_path).convert('RGB').save(buffer, 'PNG')
+                inputs.append(buffer.getvalue())
+            else:
+                inputs.append(str(image_path))
+
+        with open(result_pdf, 'wb') as f:
+            f.write(img2pdf.convert(inputs))
+
+    def convert_images_with_pil(self, images: List[Path], result_pdf: Path):
+        # PIL decodes/encodes in C with the GIL released, so threads parallelize
+        # as well as processes without fork and pickling overhead.
+        with ThreadPoolExecutor(max_workers=self.CPU) as executor:
+            pdf_buffers = [io.BytesIO(pdf_bytes)
+                           for pdf_bytes in executor.map(convert_image_to_pdf, images,
+                                                         repeat(self.resolution), repeat(self.max_dim))]
+
+        self.merge_pdfs(*pdf_buffers, result_pdf=result_pdf)
+
+    @classmethod
+    def merge_pdfs(cls, *pdfs: Union[Path, io.BytesIO], result_pdf: Path):
+        pdf_path = None
+        merged_pdf = pikepdf.Pdf.new()
+        try:
+            for i, pdf_path in enumerate(pdfs, start=1):
+                with pikepdf.open(pdf_path) as pdf:
+                    merged_pdf.pages.extend(pdf.pages)
+
+                if i % cls.MERGE_SPILL_EVERY == 0 and i != len(pdfs):
+                    # Spill the partial result to disk and reopen it lazily,
+                    # so peak memory does not grow with the number of sources.
+                    merged_pdf.save(result_pdf, compress_streams=False)
+                    merged_pdf.close()
+                    merged_pdf = pikepdf.open(result_pdf, allow_overwriting_input=True)
+
+            merged_pdf.save(result_pdf, compress_streams=False)
         except Exception:
             raise Exception(f'Unable to convert an empty file: {pdf_path}')
 
         finally:
-            pdf_merger.close()
+            merged_pdf.close()
 
-    def merge(self, force: bool = False, delete_temp: bool = True, merge_to_one_pdf: bool = False):
+    def merge(self, force: bool = False, merge_to_one_pdf: bool = False):
         start = time.time()
 
-        temp_folder: Path = self.base_folder.parent / self.TEMPORARY_FOLDER_NAME
         chapters_folder = self.result_folder
 
         if force and chapters_folder.exists():
             shutil.rmtree(chapters_folder)
 
+        used_cache_keys = set()
         try:
-            self.convert_images_in_folder_to_pdf(self.base_folder, result_pdf=chapters_folder / '0.pdf')
-            chapters_folders = []
-            for f in sorted(os.listdir(self.base_folder), key=lambda p: int(Path(p).name)):
-                f: Path = self.base_folder / f
-                if f.is_dir():
-                    chapters_folders.append(f)
-
-            for i, folder_path in enumerate(chapters_folders, start=1):
-                self.convert_images_in_folder_to_pdf(folder=folder_path, result_pdf=chapters_folder / f'{i}.pdf')
-                self.logger.info(f'{i}/{len(chapters_folders)} chapter generated to {chapters_folder / f"{i}.pdf"}')
-
-            if merge_to_one_pdf:
-                pdfs = [chapters_folder / f for f in os.listdir(chapters_folder)]
-                self.logger.info(f'Merging into one pdf - {self.result_pdf}: {", ".join(map(str, pdfs))}')
-                self.merge_pdfs(*pdfs, result_pdf=self.result_pdf)
+            used_cache_keys.add(self.convert_images_in_folder_to_pdf(self.base_folder,
+                                                                     result_pdf=chapters_folder / '0.pdf',
+                                                                     force=force))
+            with os.scandir(self.base_folder) as entries:
+                chapters_folders = [Path(entry.path) for entry in entries if entry.is_dir()]
+
+            chapters_folders.sort(key=lambda folder: int(folder.name))
+
+            merged_pdf = pikepdf.Pdf.new() if merge_to_one_pdf else None
+            if merged_pdf is not None and (chapters_folder / '0.pdf').exists():
+                with pikepdf.open(chapters_folder / '0.pdf') as pdf:
+                    merged_pdf.pages.extend(pdf.pages)
+
+            # Chapters convert independently, so spread them over processes
+            # instead of finishing one chapter before starting the next.
+            # When a single output pdf is requested, finished chapters are
+            # appended to it in order while the rest are still converting.
+            ready_chapters = {}
+            next_chapter = 1
+            cores = physical_core_ids()
+            if hasattr(os, 'sched_getaffinity'):
+                affinity = os.sched_getaffinity(0)
+                cores = [core for core in cores if core in affinity] or sorted(affinity)
+            with ProcessPoolExecutor(max_workers=self.CPU,
+                                     initializer=_init_chapter_worker,
+                                     initargs=(Value('i', 0), cores)) as executor:
+                futures = {}
+                for i, folder_path in enumerate(chapters_folders, start=1):
+                    future = executor.submit(self.convert_images_in_folder_to_pdf,
+                                             folder=folder_path, result_pdf=chapters_folder / f'{i}.pdf',
+                                             force=force)
+                    futures[future] = (i, folder_path)
+
+                for done, future in enumerate(as_completed(futures), start=1):
+                    i, folder_path = futures[future]
+                    used_cache_keys.add(future.result())
+                    self.logger.info(f'{done}/{len(chapters_folders)} chapter generated'
+                                     f' to {chapters_folder / f"{i}.pdf"}')
+
+                    if merged_pdf is None:
+                        continue
+
+                    ready_chapters[i] = chapters_folder / f'{i}.pdf'
+                    while next_chapter in ready_chapters:
+                        chapter_pdf = ready_chapters.pop(next_chapter)
+                        if chapter_pdf.exists():
+                            with pikepdf.open(chapter_pdf) as pdf:
+                                merged_pdf.pages.extend(pdf.pages)
+
+                        next_chapter += 1
+
+            if merged_pdf is not None:
+                merged_pdf.save(self.result_pdf, compress_streams=False)
+                merged_pdf.close()
                 self.logger.info(f'Result one pdf stored in {self.result_pdf}')
+
+            self.prune_pdf_cache(used_cache_keys)
         except Exception as e:
-            self.logger.error(f'{e}. {folder_path}')
+            self.logger.error(f'{e}')
             raise e
-        finally:
-            if delete_temp:
-                self.logger.debug(f'Deleting temp: {temp_folder}')
-                shutil.rmtree(temp_folder)
 
         self.logger.info(f'Finished within {round(time.time() - start, 2)} sec')
         self.logger.info(f'Result stored in {self.result_folder}')
@@ -142,10 +302,10 @@ class MangaPDFMerger:
     @staticmethod
     def join_every_N_pdfs(folder: Path, n: int):
         pdfs = [Path(folder, f) for f in os.listdir(folder) if f.endswith('.pdf')]
-        pdfs.sort(key=lambda file_path: int(file_path.name.replace(file_path.suffix, '')))
+        pdfs.sort(key=lambda file_path: int(file_path.stem))
         for start in range(0, len(pdfs), n):
             files = pdfs[start:start + n]
-            result_pdf = Path(folder, f'{files[0].name.replace(files[0].suffix, "")}-{files[-1].name}')
+            result_pdf = Path(folder, f'{files[0].stem}-{files[-1].name}')
             MangaPDFMerger.merge_pdfs(*files, result_pdf=result_pdf)
 
             for f in files: